@@ -1,8 +1,79 @@
-from collections import Counter
-import json
+import asyncio
+from collections import Counter, defaultdict
+import contextlib
+import functools
+import hashlib
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
 import random
-import traceback
-from ollama import generate
+import re
+import sys
+import weakref
+from ollama import AsyncClient
+try:
+    from orjson import loads as parse_json  # faster parsing of LLM responses, if installed.
+except ImportError:
+    from json import loads as parse_json
+
+
+client = AsyncClient()  # shared client, so that connections to the Ollama server are reused between calls.
+log = logging.getLogger("bugpoker")
+
+# Requests in flight are limited per model, so one model's backlog doesn't crowd out the others on the server, while
+# different models still run in parallel. Defaults to one at a time; set OLLAMA_NUM_PARALLEL to match the server's.
+max_requests_per_model = int(os.environ.get("OLLAMA_NUM_PARALLEL", 1))
+model_semaphores = weakref.WeakKeyDictionary()  # map of event loops -> map of model names -> semaphore for its requests.
+
+
+def get_model_semaphore(model_name):
+    # Return the semaphore limiting requests to a model. Semaphores are bound to the event loop they are first used in,
+    # so each loop (e.g. each asyncio.run) gets its own.
+    loop = asyncio.get_running_loop()
+    if loop not in model_semaphores:
+        model_semaphores[loop] = defaultdict(lambda: asyncio.Semaphore(max_requests_per_model))
+    return model_semaphores[loop][model_name]
+
+
+class InvalidLLMResponse(ValueError):
+    # Raised when an LLM's response parses, but isn't a valid move.
+    pass
+
+
+async def generate_json(**request):
+    # Stream a chat response from the Ollama server and return the text up to the end of its top-level JSON object.
+    # The stream is still read to the end after the object, so that its connection goes back to the client's pool;
+    # with a JSON schema as the format, the server stops generating at the closing brace anyway.
+    chunks = []
+    complete = False  # whether the top-level object has ended.
+    depth = 0  # how many JSON objects deep we are.
+    in_string = escaped = False  # whether we are inside a JSON string, and just after a backslash in it.
+    async with get_model_semaphore(request["model"]), contextlib.aclosing(await client.chat(**request, stream=True)) as stream:
+        async for chunk in stream:
+            if complete:  # ignore anything after the object.
+                continue
+            text = chunk.message.content
+            for i, char in enumerate(text):
+                if in_string:  # braces inside strings don't count.
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == "{":
+                    depth += 1
+                elif depth > 0 and char == '"':
+                    in_string = True
+                elif depth > 0 and char == "}":
+                    depth -= 1
+                    if depth == 0:  # object is complete.
+                        complete = True
+                        text = text[:i+1]
+                        break
+            chunks.append(text)
+    return "".join(chunks)  # if the stream ended without a complete object, let the caller deal with it.
 
 
 class LlmPlayer():
@@ -31,13 +102,30 @@ class LlmPlayer():
         Other players can tell the truth when claiming what a card is. They do not have to lie.
     """
 
-    def __init__(self, model_name, name):
+    # Instructions shared by every player and every turn. They are sent as the system message, byte-for-byte identical each time,
+    # so the Ollama server can reuse its cached prefix instead of re-processing it every turn.
+    static_prefix = context + "\n" + finetune_instructions
+
+    keep_alive = -1  # keep models loaded on the server indefinitely, so they aren't reloaded between turns.
+    options = {
+        "num_predict": 256,  # responses are short JSON objects, so cap how long a rambling model can go on.
+        "stop": ["\n\n"],  # a blank line means the model has moved on from the JSON object.
+    }
+    cached_options = options | {"temperature": 0, "seed": 0}  # with a response cache, responses must be deterministic to be worth replaying.
+    pending_responses = dict()  # map of cache keys -> futures for cacheable requests in flight, shared by all players.
+    pending_waiters = Counter()  # map of cache keys -> number of games waiting for that request.
+
+    def __init__(self, model_name, name, cache=None):
         self.model_name = model_name
         self.name = name
-        self.context += f"\nYour name is {name} and you are playing a game of Cockroach Poker."
+        self.cache = cache  # mapping of request hashes -> responses (e.g. a shelve.Shelf), or None to always ask the LLM.
+        self.identity = f"Your name is {name} and you are playing a game of Cockroach Poker."  # goes after the static prefix.
 
-    def generate_json_format(self, required_keys):
-        # Generate a JSON schema for the response.
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def generate_json_format(required_keys):
+        # Generate a JSON schema for the response, given a tuple of required keys.
+        # Only a handful of key sets are ever used, so schemas are cached. Don't modify the returned schema.
         return {
         "type": "object",
         "properties": {
@@ -63,27 +151,64 @@ class LlmPlayer():
                 "type": "string"
             },
         },
-        "required": required_keys
+        "required": list(required_keys)
     }
 
-    def play(self, game_state, instructions, required_keys):
-        # Play move by getting a response from the LLM, given some context.
+    async def play(self, game_state, instructions, required_keys):
+        # Play move by getting a response from the LLM, given some context and a tuple of the keys the response must have.
         # print("!!! PROMPT !!!", instructions)
-        generate_response = generate(
+        # The static prefix is sent as the system message, so the server can reuse its cached prefix across turns.
+        messages = [
+            {"role": "system", "content": self.static_prefix},
+            {"role": "user", "content": '\n'.join([self.identity, game_state, instructions])},
+        ]
+        request = dict(
             model = self.model_name,
-            prompt = '\n'.join([self.context, game_state, instructions, self.finetune_instructions]),
-            format = self.generate_json_format(required_keys)
+            messages = messages,
+            format = self.generate_json_format(required_keys),
+            options = self.options if self.cache is None else self.cached_options,
+            keep_alive = self.keep_alive
         )
-        return generate_response.response
+        if self.cache is None:
+            return await generate_json(**request)
+        key = hashlib.blake2b(repr((self.model_name, messages, required_keys)).encode(), digest_size=16).hexdigest()
+        if key in self.cache:
+            return self.cache[key]
+        response = self.pending_responses.get(key)
+        if response is None:  # not seen this exact prompt before. Concurrent games asking the same thing wait for one response.
+            response = asyncio.ensure_future(generate_json(**request))
+            response.add_done_callback(functools.partial(self.store_response, key))
+            self.pending_responses[key] = response
+        self.pending_waiters[key] += 1
+        try:
+            return await asyncio.shield(response)  # one game being cancelled doesn't cancel the request for the others.
+        finally:
+            self.pending_waiters[key] -= 1
+            if not self.pending_waiters[key]:
+                del self.pending_waiters[key]
+                if not response.done():  # nobody is waiting any more, e.g. for an unneeded speculative request.
+                    response.cancel()
+                    if self.pending_responses.get(key) is response:  # the same prompt asked again later starts a new request.
+                        del self.pending_responses[key]
+
+    def store_response(self, key, response):
+        # Once a shared request finishes, stop sharing it and save its response in the cache, if it has one.
+        if self.pending_responses.get(key) is response:  # not already removed after being cancelled.
+            del self.pending_responses[key]
+        if not response.cancelled() and response.exception() is None:
+            self.cache[key] = response.result()
 
 
 class Move:
     # Class to store player moves in a structured format.
+    __slots__ = ("player", "action", "target", "card", "claim", "guess", "reason")  # no per-move __dict__; there is one Move per turn.
     valid_moves = ["PLAY", "LOOK", "PASS", "GUESS", "FORFEIT"]
     max_player_length = 20
     max_action_length = 7
     max_card_length = 9
     max_guess_length = 7
+    # Format for the __repr__ columns: player, action, target, card, claim, guess, each truncated and right-justified.
+    row_format = f"{{:>{max_player_length}.{max_player_length}s}} {{:>{max_action_length}.{max_action_length}s}} {{:>{max_player_length}.{max_player_length}s}} {{:>{max_card_length}.{max_card_length}s}} {{:>{max_card_length}.{max_card_length}s}} {{:>{max_guess_length}.{max_guess_length}s}}"
 
     def __init__(self, player, action, target="", card="", claim="", guess="", reason=""):
         self.player = player
@@ -94,11 +219,6 @@ class Move:
         self.guess = guess
         self.reason = reason
 
-    @staticmethod
-    def rtrunc(s, width):
-        # Truncate, then right-justify, to a given width.
-        return s[:width].rjust(width)
-
     def get_loser(self):
         if self.action == "FORFEIT":
             return 
@@ -124,34 +244,27 @@ class Move:
 
     def __repr__(self):
         # Full representation of an action. Intended to be used for logging.
-        return " ".join([
-            self.rtrunc(self.player, Move.max_player_length),
-            self.rtrunc(self.action, Move.max_action_length),
-            self.rtrunc(self.target, Move.max_player_length),
-            self.rtrunc(self.card, Move.max_card_length),
-            self.rtrunc(self.claim, Move.max_card_length),
-            self.rtrunc(self.guess, Move.max_guess_length),
-        ])
+        return self.row_format.format(self.player, self.action, self.target, self.card, self.claim, self.guess)
     
     @staticmethod
     def print_header():
         # Print out the header for the __repr__ format.
-        return " ".join([
-            Move.rtrunc("PLAYER", Move.max_player_length),
-            Move.rtrunc("ACTION", Move.max_action_length),
-            Move.rtrunc("TARGET", Move.max_player_length),
-            Move.rtrunc("CARD", Move.max_card_length),
-            Move.rtrunc("CLAIM", Move.max_card_length),
-            Move.rtrunc("GUESS", Move.max_guess_length),
-        ])
+        return Move.row_format.format("PLAYER", "ACTION", "TARGET", "CARD", "CLAIM", "GUESS")
 
 
 class Runner:
     # Runs games of Cockroach Poker with the same players.
-    types = ["COCKROACH", "BAT", "FLY", "FROG", "RAT", "SCORPION", "SPIDER", "STINKBUG"]
-    deck = types * 8
+    types = ("COCKROACH", "BAT", "FLY", "FROG", "RAT", "SCORPION", "SPIDER", "STINKBUG")
+    type_index = {card: i for (i, card) in enumerate(types)}  # map of card names -> index into types.
+    alphabetical_type_indices = sorted(range(len(types)), key=types.__getitem__)  # indices into types, in alphabetical order of card name.
+    types_prompt = ", ".join(sorted(types))  # card types as written in prompts, e.g. "BAT, COCKROACH, ...".
 
-    def __init__(self, model_names):
+    def __init__(self, model_names, cache=None, speculate=False):
+        self.model_names = model_names
+        self.cache = cache  # shared response cache for all players, see LlmPlayer.
+        self.speculate = speculate  # whether to ask for the PASS after a LOOK while the player is still deciding whether to LOOK.
+        self.speculative_pass = None  # task for that speculative request, if one is in flight.
+        self.deck = bytearray(range(len(self.types))) * 8  # cards as indices into types. Each Runner gets its own deck, since set_up_game shuffles it in place.
         self.multiple_same_models = {n for n in model_names if model_names.count(n) > 1}  # set of all model names that appear more than once.
         self.model_names_counter = Counter()
         self.players = dict()  # map of player names -> Player objects.
@@ -161,8 +274,13 @@ class Runner:
                 name = f"{model_name}_{self.model_names_counter[model_name]}"
             else:
                 name = model_name
-            self.players[name] = LlmPlayer(model_name, name)
+            self.players[name] = LlmPlayer(model_name, name, cache)
+        self.player_names = tuple(self.players)
+        self.player_bits = {player: 1 << i for (i, player) in enumerate(self.player_names)}  # map of player names -> their bit in a bitmask of players.
+        self.all_players = (1 << len(self.player_names)) - 1  # bitmask of every player.
+        self.target_names = dict()  # map of bitmasks of players -> cached names, see get_target_names.
         self.losses = Counter()
+        self.deal_losers = dict()  # map of deal ids -> player who lost the game with that deal.
         self.set_up_game()
 
     def chunk_cards_equally(self):
@@ -171,236 +289,394 @@ class Runner:
         for i in range(len(self.players)):
             yield self.deck[i*k+min(i, m):(i+1)*k+min(i+1, m)]
 
-    def set_up_game(self, starting_player=None):
+    def prepare_deals(self, n, seed=None):
+        # Shuffle decks and pick starting players for n games up front, all from one random generator.
+        # With a seed, the same n games are dealt on every run.
+        rng = random.Random(seed)
+        sorted_deck = sorted(self.deck)  # shuffle from the same starting order every time.
+        self.deals = [(bytes(rng.sample(sorted_deck, len(sorted_deck))), rng.choice(self.player_names)) for _ in range(n)]  # list of (deck, starting player).
+
+    def set_up_game(self, game_index=None, starting_player=None):
         # Set up a new game by dealing out cards and picking a player to start.
-        random.shuffle(self.deck)  # shuffle deck in-place.
-        self.player_hands = {player: Counter(chunk) for (player, chunk) in zip(self.players.keys(), self.chunk_cards_equally())}  # map of player names -> player cards (hidden).
-        self.player_revealed = {player: Counter() for player in self.players.keys()}  # map of player names -> table cards (revealed).
+        # If a game index is given, use that game's prepared deal from prepare_deals.
+        if game_index is not None:
+            deck, starting_player = self.deals[game_index]
+            self.deck[:] = deck
+        else:
+            random.shuffle(self.deck)  # shuffle deck in-place.
+        # Cards held or revealed are stored as counts of each card type, indexed like types.
+        self.player_hands = {player: bytearray(map(chunk.count, range(len(self.types)))) for (player, chunk) in zip(self.players.keys(), self.chunk_cards_equally())}  # map of player names -> player cards (hidden).
+        self.player_revealed = {player: bytearray(len(self.types)) for player in self.players.keys()}  # map of player names -> table cards (revealed).
+        self.player_hand_totals = {player: sum(hand) for (player, hand) in self.player_hands.items()}  # map of player names -> number of cards in hand.
+        self.player_max_revealed = dict.fromkeys(self.players.keys(), 0)  # map of player names -> highest count of any one revealed type.
+        self.revealed_lines = dict()  # map of player names -> cached lines describing their revealed cards.
         if starting_player:
             self.current_player = starting_player  # use provided starting player.
         else:
-            self.current_player = random.choice(list(self.players.keys()))  # pick random starting player.
+            self.current_player = random.choice(self.player_names)  # pick random starting player.
+        self.deal_id = hashlib.blake2b(self.deck + self.current_player.encode(), digest_size=8).hexdigest()  # identifies this deal, to compare games on it across runs.
+        self.rng = random.Random(self.deal_id)  # randomness during the game, seeded by the deal so that cached games replay exactly.
 
-    def get_enumerated_cards(self, counter):
+    def get_enumerated_cards(self, counts):
         # Return a string of enumerated cards in alphabetical order, e.g. "1x COCKROACH, 3x SCORPION, 1x STINKBUG."
-        return ", ".join(f"{count}x {card}" for (card, count) in sorted(counter.items()) if count > 0)
+        return ", ".join(f"{counts[i]}x {self.types[i]}" for i in self.alphabetical_type_indices if counts[i] > 0)
+
+    def take_card_from_hand(self, player, card_index):
+        # Remove a card from a player's hand.
+        self.player_hands[player][card_index] -= 1
+        self.player_hand_totals[player] -= 1
+
+    def reveal_card(self, player, card):
+        # Put a card face-up in front of a player.
+        revealed = self.player_revealed[player]
+        card_index = self.type_index[card]
+        revealed[card_index] += 1
+        self.player_max_revealed[player] = max(self.player_max_revealed[player], revealed[card_index])
+        self.revealed_lines.pop(player, None)  # rebuilt on next use.
+
+    def get_revealed_lines(self, player):
+        # Get the lines describing a player's revealed cards, as a tuple of (line for other players, line for that player).
+        # Cached until the player's revealed cards change, since they are written into every prompt.
+        lines = self.revealed_lines.get(player)
+        if lines is None:
+            cards = self.get_enumerated_cards(self.player_revealed[player])
+            lines = (f"In front of player {player} are: {cards}.", f"In front of player {player} (you) are: {cards}.")
+            self.revealed_lines[player] = lines
+        return lines
 
     def write_revealed_state(self, current_player_name):
         # Write the current state of revealed cards as a string.
-        # e.g. "In front of you are 2x BAT, 4x RAT, 1x SCORPION."
+        # e.g. "In front of player gemma3:12b (you) are: 2x BAT, 4x RAT, 1x SCORPION."
         state = ["The following cards are revealed face-up on the table:"]
-        for player, revealed in self.player_revealed.items():
-            state.append(f"\nIn front of player {"(you)" if player == current_player_name else ""} are: {self.get_enumerated_cards(revealed)}.")
-        return "\n".join(state)
+        state.extend(self.get_revealed_lines(player)[player == current_player_name] for player in self.player_revealed)
+        return "\n\n".join(state)
 
     def check_for_loser(self):
         # Check if anyone has lost the game. If so, return their name. Otherwise, return None.
-        for player, hand in self.player_hands.items():
-            if sum(hand.values()) == 0:  # no more cards in hand.
+        # Uses the running totals kept by take_card_from_hand and reveal_card, rather than counting every card.
+        for player, total in self.player_hand_totals.items():
+            if total == 0:  # no more cards in hand.
                 return player, "No more cards in hand"
-        for player, revealed in self.player_revealed.items():
-            for card, count in revealed.items():
-                if count == 4:  # four of the type.
-                    return player, f"4x {card}"
+        for player, max_revealed in self.player_max_revealed.items():
+            if max_revealed == 4:  # four of the type.
+                return player, f"4x {self.types[self.player_revealed[player].index(4)]}"
         return None, None
 
-    def get_response_from_current_player(self, instructions, required_keys):
-        # Get the parsed response from the current player.
-        raw_response = self.players[self.current_player].play(
-            self.write_revealed_state(self.current_player), 
+    def get_target_names(self, targets):
+        # Return the names of the players in a bitmask of players, as a comma-separated string for prompts.
+        # Cached per bitmask, since the same few bitmasks come up every round.
+        names = self.target_names.get(targets)
+        if names is None:
+            names = ", ".join(player for player in self.player_names if targets & self.player_bits[player])
+            self.target_names[targets] = names
+        return names
+
+    def is_target(self, targets, player):
+        # Return whether a player (possibly any JSON value given by an LLM) is in a bitmask of players.
+        return isinstance(player, str) and bool(targets & self.player_bits.get(player, 0))
+
+    def ask_current_player(self, instructions, required_keys):
+        # Return a coroutine asking the current player for the raw text of their response.
+        return self.players[self.current_player].play(
+            self.write_revealed_state(self.current_player),
             instructions,
             required_keys
         )
-        raw_response = raw_response[raw_response.find("{"):raw_response.rfind("}")+1]  # trim to brackets.
-        response = json.loads(raw_response)
-        print("> " + self.current_player + " says: '" + response.get("reason", "[No reason given]") + "'")
+
+    def request_response_from_current_player(self, instructions, required_keys):
+        # Start asking the current player for a response in the background, and return the task for its raw text.
+        return asyncio.ensure_future(self.ask_current_player(instructions, required_keys))
+
+    async def get_response_from_current_player(self, instructions, required_keys, request=None):
+        # Get the parsed response from the current player. If a request for it was already started, wait for that one.
+        raw_response = await (request or self.ask_current_player(instructions, required_keys))
+        try:
+            response = parse_json(raw_response)  # responses are constrained to the JSON schema, so this usually just works.
+        except ValueError:  # model wrapped the JSON object in other text anyway.
+            match = re.search(r"\{.*\}", raw_response, re.S)
+            if match is None:
+                raise
+            response = parse_json(match.group())
+        log.info("> %s says: '%s'", self.current_player, response.get("reason", "[No reason given]"))
         return response
     
-    def get_all_claims_this_round(self, history):
-        # Get all claims made in the current round, as a string in the form:
+    def record_claim(self, move):
+        # Record the claim made by a PLAY or PASS move, as a tuple of (target, line for other players, line for the target).
+        self.round_claims.append((
+            move.target,
+            f"{move.player} passed a card to {move.target} and claimed it was a {move.claim}.",
+            f"{move.player} passed a card to you and claimed it was a {move.claim}.",
+        ))
+
+    def get_all_claims_this_round(self):
+        # Get all claims made in the current round, most recent first, as a string in the form:
         # [player] passed it to [player] and claimed it was a [card].
         # [player] passed it to you and claimed it was a [card].
         all_claims = ["So far this round:"]
-        for move in history[::-1]:
-            if move.action in ["PLAY", "PASS"]:
-                all_claims.append(f"{move.player} passed a card to {'you' if move.target == self.current_player else move.target} and claimed it was a {move.claim}.")
-                if move.action == "PLAY":
-                    break
+        all_claims.extend(you_line if target == self.current_player else line for (target, line, you_line) in reversed(self.round_claims))
         return " ".join(all_claims)
 
-    def play_move(self, valid_targets, history):
-        if len(valid_targets) == len(self.players) - 1:  # first move of the round. Must attack.
+    def log_forfeit(self, e):
+        # Log why the current player's response was rejected.
+        # Tracebacks are only logged at DEBUG level, and only formatted when that level is enabled.
+        log.warning("%s forfeits: %s", self.current_player, e)
+        if not isinstance(e, InvalidLLMResponse):
+            log.debug("Traceback for %s's forfeit:", self.current_player, exc_info=e)
+
+    def is_type(self, card):
+        # Return whether a card name (possibly any JSON value given by an LLM) is a valid card type.
+        return isinstance(card, str) and card in self.type_index
+
+    @staticmethod
+    def is_guess(guess):
+        # Return whether a guess is TRUE or FALSE, in any case, or sent as a bool.
+        return isinstance(guess, bool) or (isinstance(guess, str) and guess.upper() in ("TRUE", "FALSE"))
+
+    @staticmethod
+    def validate(response, checks):
+        # Check a response against (key, predicate, error message) checks in one pass, and raise an InvalidLLMResponse listing every failure.
+        # Keys are checked for presence, then values with the predicate (if any). Messages can include the value as {}.
+        errors = []
+        for key, is_valid, error in checks:
+            if key not in response:
+                errors.append(f"Missing key '{key}' in response.")
+            elif is_valid is not None and not is_valid(response[key]):
+                errors.append(error.format(response[key]))
+        if errors:
+            raise InvalidLLMResponse(" ".join(errors))
+
+    def make_play_move(self, response, valid_targets):
+        # Validate a response to start a round and return the PLAY move, taking the card from the player's hand.
+        hand = self.player_hands[self.current_player]
+        self.validate(response, (
+            ("target", functools.partial(self.is_target, valid_targets), "Player {} is not a valid target."),
+            ("card", lambda card: self.is_type(card) and hand[self.type_index[card]] > 0, "Tried to play a {}, which is not a card type in their hand."),
+            ("claim", self.is_type, "Claimed their card was a {}, an invalid type."),
+            ("reason", None, None),
+        ))
+        self.take_card_from_hand(self.current_player, self.type_index[response["card"]])
+        return Move(self.current_player, "PLAY", target=response["target"], card=response["card"], claim=response["claim"], reason=response["reason"])
+
+    def make_pass_move(self, response, valid_targets, last_move):
+        # Validate a response to pass on a card that was looked at and return the PASS move.
+        self.validate(response, (
+            ("target", functools.partial(self.is_target, valid_targets), "Player {} is not a valid target."),
+            ("claim", self.is_type, "Claimed their card was a {}, an invalid type."),
+            ("reason", None, None),
+        ))
+        return Move(self.current_player, "PASS", target=response["target"], card=last_move.card, claim=response["claim"], reason=response["reason"])
+
+    def make_look_move(self, response, last_move):
+        # Validate a response to look at a card and return the LOOK move.
+        self.validate(response, (("reason", None, None),))
+        return Move(self.current_player, "LOOK", target=last_move.player, card=last_move.card, claim=last_move.claim, reason=response["reason"])
+
+    def make_guess_move(self, response, last_move):
+        # Validate a response guessing whether the last claim is true and return the GUESS move.
+        self.validate(response, (
+            ("guess", self.is_guess, "Guess must be either TRUE or FALSE, not {}."),
+            ("reason", None, None),
+        ))
+        guess = response["guess"]
+        if isinstance(guess, bool):  # cast bool to string in case it was sent as a bool.
+            guess = "TRUE" if guess else "FALSE"
+        return Move(self.current_player, "GUESS", target=last_move.player, card=last_move.card, claim=last_move.claim, guess=guess.upper(), reason=response["reason"])
+
+    def write_pass_instructions(self, valid_targets, last_move):
+        # Write the instructions for passing on a card after looking at it, and return them with the keys the response needs.
+        instructions = "\n".join([
+            self.get_all_claims_this_round(),
+            f"You looked at the card that {last_move.target} passed to you. It is a {last_move.card}, {'and' if last_move.claim == last_move.card else 'but'} {last_move.player} claimed it was a {last_move.claim}.",
+            f"You need to pass the card to another player. You can pass to the following players: {self.get_target_names(valid_targets)}."
+            f"You can claim your card is any one of the following: {self.types_prompt}.",
+            f"But remember, {last_move.target} claimed the card was a {last_move.claim}.",
+            "Return a raw JSON object as a string with the keys 'target' (the player you want to pass to), 'claim' (what you claim your card is, you can tell the truth or lie), and 'reason' (the reason why you chose this move)."
+        ])
+        return instructions, ("target", "claim", "reason")
+
+    async def play_move(self, valid_targets, history):
+        # Play the current player's move, given the bitmask of players they can pass to and the moves so far this round.
+        # If the response is invalid, the player forfeits.
+        request = None  # request for the response that was already started, if any.
+        if valid_targets.bit_count() == len(self.players) - 1:  # first move of the round. Must attack.
+            hand = self.get_enumerated_cards(self.player_hands[self.current_player])
             instructions = "\n".join([
-                f"You must play one of the cards from your hand: {self.get_enumerated_cards(self.player_hands[self.current_player])}.",
-                f"You can target the following players: {", ".join(valid_targets)}.",
-                f"You can claim your card is any one of the following: {self.types}.",
+                f"You must play one of the cards from your hand: {hand}.",
+                f"You can target the following players: {self.get_target_names(valid_targets)}.",
+                f"You can claim your card is any one of the following: {self.types_prompt}.",
                 "Return a raw JSON object as a string with the keys 'target' (the player you want to pass to), 'card' (only the card you want to play, do not include the '1x', '2x', etc. count), 'claim' (the bug you claim your card is, you can either tell the truth or lie), and 'reason' (the reason why you chose this move)."
             ])
-            required_keys = ["target", "card", "claim", "reason"]
-            try:
-                print("current hand is:", self.get_enumerated_cards(self.player_hands[self.current_player]))
-                response = self.get_response_from_current_player(instructions, required_keys)
-                for key in ["card", "target", "claim", "reason"]:
-                    if key not in response:
-                        raise ValueError(f"Missing key '{key}' in response.")
-                if response["target"] not in valid_targets:
-                    raise ValueError(f"Player {response['target']} is not a valid target.")
-                if response["card"] not in self.types:
-                    raise ValueError(f"Player {self.current_player} tried to play a {response['card']}, an invalid type.")
-                if response["card"] not in self.player_hands[self.current_player] or self.player_hands[self.current_player][response["card"]] < 1:
-                    raise ValueError(f"Player {self.current_player} does not have {response['card']} in their hand.")
-                if response["claim"] not in self.types:
-                    raise ValueError(f"Player {self.current_player} claimed their card was a {response['claim']}, an invalid type.")
-                self.player_hands[self.current_player][response["card"]] -= 1  # decrement card count.
-                return Move(self.current_player, "PLAY", target=response["target"], card=response["card"], claim=response["claim"], reason=response["reason"])
-            except Exception as e:
-                print(e, traceback.format_exc())
-                return Move(self.current_player, "FORFEIT", reason=f"Error parsing response: {e}")
-        elif len(valid_targets) == 0:  # forced last move of the round. Must guess.
+            required_keys = ("target", "card", "claim", "reason")
+            forfeit_card = ""  # no card has been played yet.
+            log.info("current hand is: %s", hand)
+            make_move = lambda response: self.make_play_move(response, valid_targets)
+        elif valid_targets == 0:  # forced last move of the round. Must guess.
             last_move = history[-1]
             instructions = "\n".join([
-                self.get_all_claims_this_round(history),
+                self.get_all_claims_this_round(),
                 f"You must determine whether the last claim — {last_move.player} claiming that the card they passed to you is a {last_move.claim} — is TRUE or FALSE.",
                 f"Return a raw JSON object as a string with the keys 'guess' (TRUE if you think {last_move.player} is telling the truth, or FALSE if you think {last_move.player} is lying), and 'reason' (the reason why you think so)."
             ])
-            required_keys = ["guess", "reason"]
-            try:
-                response = self.get_response_from_current_player(instructions, required_keys)
-                for key in ["guess", "reason"]:
-                    if key not in response:
-                        raise ValueError(f"Missing key '{key}' in response.")
-                if type(response["guess"]) == bool:  # cast bool to string in case it was sent as a bool.
-                    response["guess"] = "TRUE" if response["guess"] else "FALSE"
-                if type(response["guess"]) != str:  # check if guess is a string.
-                    raise ValueError(f"Guess must be a string.")
-                response["guess"] = response["guess"].upper()
-                if response["guess"] not in ["TRUE", "FALSE"]:
-                    raise ValueError(f"Guess must be either TRUE or FALSE.")
-                return Move(self.current_player, "GUESS", target=last_move.player, card=last_move.card, claim=last_move.claim, guess=response["guess"], reason=response["reason"])
-            except Exception as e:
-                print(e, traceback.format_exc())
-                return Move(self.current_player, "FORFEIT", card=last_move.card, reason=f"Error parsing response: {e}")
+            required_keys = ("guess", "reason")
+            forfeit_card = last_move.card
+            make_move = lambda response: self.make_guess_move(response, last_move)
         elif history[-1].action == "LOOK":  # looked at card last round, must pass.
             last_move = history[-1]
-            instructions = "\n".join([
-                self.get_all_claims_this_round(history),
-                f"You looked at the card that {last_move.target} passed to you. It is a {last_move.card}, {'and' if last_move.claim == last_move.card else 'but'} {last_move.player} claimed it was a {last_move.claim}.",
-                f"You need to pass the card to another player. You can pass to the following players: {", ".join(valid_targets)}."
-                f"You can claim your card is any one of the following: {self.types}.",
-                f"But remember, {last_move.target} claimed the card was a {last_move.claim}.",
-                "Return a raw JSON object as a string with the keys 'target' (the player you want to pass to), 'claim' (what you claim your card is, you can tell the truth or lie), and 'reason' (the reason why you chose this move)."
-            ])
-            required_keys = ["target", "claim", "reason"]
-            try:
-                response = self.get_response_from_current_player(instructions, required_keys)
-                for key in ["target", "claim", "reason"]:
-                    if key not in response:
-                        raise ValueError(f"Missing key '{key}' in response.")
-                if response["target"] not in valid_targets:
-                    raise ValueError(f"Player {response['target']} is not a valid target.")
-                if response["claim"] not in self.types:
-                    raise ValueError(f"Player {response['target']} claimed their card was a {response['claim']}, an invalid type.")
-                return Move(self.current_player, "PASS", target=response["target"], card=last_move.card, claim=response["claim"], reason=response["reason"])
-            except Exception as e:
-                print(e, traceback.format_exc())
-                return Move(self.current_player, "FORFEIT", card=last_move.card, reason=f"Error parsing response: {e}")
+            instructions, required_keys = self.write_pass_instructions(valid_targets, last_move)
+            request, self.speculative_pass = self.speculative_pass, None  # already asked for while deciding to LOOK, if speculating.
+            forfeit_card = last_move.card
+            make_move = lambda response: self.make_pass_move(response, valid_targets, last_move)
         else:  # can decide whether to LOOK at card or GUESS.
             last_move = history[-1]
             instructions = "\n".join([
-                self.get_all_claims_this_round(history),
+                self.get_all_claims_this_round(),
                 "You can either LOOK at the card and pass it to another player, or try to GUESS whether this claim is TRUE or FALSE.",
                 "If you want to LOOK at the card and pass it to another player, return a raw JSON object as a string with the keys 'action' (set to 'LOOK'), 'claim' (set to 'NONE'), 'guess' (set to 'NONE') and 'reason' (the reason why you want to look and pass the card.",
                 f"If you want to GUESS whether this claim is TRUE or FALSE, return a raw JSON object as a string with the keys 'action' (set to GUESS), 'claim' (set to 'NONE'),'guess' (TRUE if you think {last_move.player} is telling the truth, or FALSE if you think {last_move.player} is lying), and 'reason' (the reason why you think so)."
             ])
-            required_keys = ["action", "claim", "guess", "reason"]
-            try:
-                response = self.get_response_from_current_player(instructions, required_keys)
-                if "action" in response and response["action"] == "LOOK":  # chose to LOOK.
-                    return Move(self.current_player, "LOOK", target=last_move.player, card=last_move.card, claim=last_move.claim, reason=response["reason"])
-                else:  # chose to GUESS.
-                    for key in ["guess", "reason"]:
-                        if key not in response:
-                            raise ValueError(f"Missing key '{key}' in response.")
-                    if type(response["guess"]) == bool:  # cast bool to string in case it was sent as a bool.
-                        response["guess"] = "TRUE" if response["guess"] else "FALSE"
-                    if type(response["guess"]) != str:  # check if guess is a string.
-                        raise ValueError(f"Guess must be a string.")
-                    response["guess"] = response["guess"].upper()
-                    if response["guess"] not in ["TRUE", "FALSE"]:
-                        raise ValueError(f"Guess must be either TRUE or FALSE.")
-                    return Move(self.current_player, "GUESS", target=last_move.player, card=last_move.card, claim=last_move.claim, guess=response["guess"], reason=response["reason"])
-            except Exception as e:
-                print(e, traceback.format_exc())
-                return Move(self.current_player, "FORFEIT", card=last_move.card, reason=f"Error parsing response: {e}")
-            
-
-    def play_round(self):
+            required_keys = ("action", "claim", "guess", "reason")
+            forfeit_card = last_move.card
+            make_move = lambda response: self.make_look_move(response, last_move) if response.get("action") == "LOOK" else self.make_guess_move(response, last_move)
+            if self.speculate:  # the PASS after a LOOK doesn't depend on the LOOK response, so start asking for it now.
+                look_move = Move(self.current_player, "LOOK", target=last_move.player, card=last_move.card, claim=last_move.claim)
+                self.speculative_pass = self.request_response_from_current_player(*self.write_pass_instructions(valid_targets, look_move))
+        try:
+            response = await self.get_response_from_current_player(instructions, required_keys, request)
+            return make_move(response)
+        except Exception as e:
+            self.log_forfeit(e)
+            return Move(self.current_player, "FORFEIT", card=forfeit_card, reason=f"Error parsing response: {e}")
+
+    async def play_round(self):
         # Play a round in an ongoing game; i.e. a series of moves until one player puts a card in front of them.
         # Return the name of the losing player, and the move history for that round.
-        valid_targets = [player for player in self.players.keys() if player != self.current_player]  # players that the current player can target by passing.
+        valid_targets = self.all_players & ~self.player_bits[self.current_player]  # bitmask of players that the current player can target by passing.
         history = []
+        self.round_claims = []  # claims made so far this round, see record_claim.
         while True:
-            move = self.play_move(valid_targets, history)
-            print(move)
+            move = await self.play_move(valid_targets, history)
+            if move.action != "LOOK" and self.speculative_pass is not None:  # didn't LOOK, so the speculative PASS isn't needed.
+                self.speculative_pass.cancel()
+                self.speculative_pass = None
+            log.info("%s", move)
             history.append(move)
             if move.action in ["PLAY", "PASS"]:
+                self.record_claim(move)
                 self.current_player = move.target
-                valid_targets = [player for player in valid_targets if player != self.current_player]  # remove targeted player from list of valid targets.
+                valid_targets &= ~self.player_bits[self.current_player]  # remove targeted player from valid targets.
             elif move.action == "GUESS":  # round end. See who loses.
                 guess = (move.guess == "TRUE")
                 guess_is_correct = (guess and move.card == move.claim) or (not guess and move.card != move.claim)
                 if guess_is_correct:  # guesser guessed correctly.
-                    self.player_revealed[move.target][move.card] += 1  # add to the claimer's revealed cards.
+                    self.reveal_card(move.target, move.card)  # add to the claimer's revealed cards.
                     self.current_player = move.target  # claimer loses, so goes first.
                     return move.target, history
                 else:  # guesser guessed incorrectly.
-                    self.player_revealed[move.player][move.card] += 1  # add to the guesser's revealed cards.
+                    self.reveal_card(move.player, move.card)  # add to the guesser's revealed cards.
                     self.current_player = move.player  # guesser loses, so goes first.
                     return move.player, history
             elif move.action == "FORFEIT":  # round end by forfeit.
                 if move.card == "":  # occasionally happens on first turn, when no card has been played yet.
-                    move.card = random.choice(list(self.player_hands[self.current_player].keys()))  # get a random card from the player's hand.
-                    self.player_hands[self.current_player][move.card] -= 1  # remove the card from the player's hand.
-                self.player_revealed[move.player][move.card] += 1  # put the card in the revealed cards in front of them.
+                    hand = self.player_hands[self.current_player]
+                    card_index = self.rng.choices(range(len(hand)), weights=hand)[0]  # get a random card from the player's hand.
+                    self.take_card_from_hand(self.current_player, card_index)
+                    move.card = self.types[card_index]
+                self.reveal_card(move.player, move.card)  # put the card in the revealed cards in front of them.
                 self.current_player = move.player  # forfeiter loses, so goes first.
                 return move.player, history
             else:  # we actually don't care about LOOK moves. Next cycle it will handle itself.
                 pass
 
-    def play_game(self):
-        # Set up and play a full game.
-        self.set_up_game()
+    async def play_game(self, game_index=None):
+        # Set up and play a full game, with a prepared deal if a game index is given.
+        self.set_up_game(game_index)
+        log.info("Dealt deal %s.", self.deal_id)
         history = []
         while True:
             # Check if anyone has lost.
             losing_player, losing_reason = self.check_for_loser()
             if losing_player is not None:
                 self.losses[losing_player] += 1
-                print(f"Player {losing_player} loses: {losing_reason}!")
-                print("Face-up cards:")  # print revealed cards.
+                self.deal_losers[self.deal_id] = losing_player
+                log.info("Player %s loses: %s!", losing_player, losing_reason)
+                log.info("Face-up cards:")  # print revealed cards.
                 for player, revealed in self.player_revealed.items():
-                    print(f"  {player} has: {self.get_enumerated_cards(revealed)}.")
+                    log.info("  %s has: %s.", player, self.get_enumerated_cards(revealed))
                 break
 
             # Otherwise, play a round.
-            print(f"New round, {self.current_player} goes first.")
-            round_loser, moves = self.play_round()
+            log.info("New round, %s goes first.", self.current_player)
+            round_loser, moves = await self.play_round()
             losing_card = moves[-1].card
-            print(f"{round_loser} lost that round and takes the {losing_card}.\n")
+            log.info("%s lost that round and takes the %s.\n", round_loser, losing_card)
             history.extend(moves)
         return history
 
-    def play_games(self, n):
+    async def load_models(self):
+        # Load every model on the Ollama server up front and keep it loaded, so models aren't swapped in and out between turns.
+        model_names = list(dict.fromkeys(self.model_names))  # unique model names, in order.
+        max_loaded_models = os.environ.get("OLLAMA_MAX_LOADED_MODELS")
+        if max_loaded_models is not None and int(max_loaded_models) < len(model_names):
+            log.warning("Warning: OLLAMA_MAX_LOADED_MODELS is %s, but %d models are playing. Models will be reloaded between turns.", max_loaded_models, len(model_names))
+        await asyncio.gather(*[client.generate(model=model_name, keep_alive=LlmPlayer.keep_alive) for model_name in model_names])  # an empty prompt just loads the model.
+
+    async def play_games(self, n, seed=None):
+        # Play n games one after another. With a seed, the same n deals are played on every run.
+        await self.load_models()
+        self.prepare_deals(n, seed)
         all_history = []
         for i in range(n):
-            print(f"Game {i+1} of {n}...")
-            history = self.play_game()
+            log.info("Game %d of %d...", i+1, n)
+            history = await self.play_game(i)
             all_history.append(history)
-            print(f"Game {i+1} of {n} complete.")
+            log.info("Game %d of %d complete.", i+1, n)
             losses_array = [f"{player}: {losses}" for player, losses in self.losses.items()]
-            print(f"  Losses: {", ".join(losses_array)}")
-            print("\n\n")
-        
+            log.info("  Losses: %s", ", ".join(losses_array))
+            log.info("\n\n")
+
+    async def play_games_async(self, n, concurrency=None, seed=None):
+        # Play n games concurrently, each on its own Runner, with at most `concurrency` games in flight at once.
+        # Each game waits on one request at a time, so by default enough games are run to keep every model busy.
+        # With a seed, the same n deals are played on every run.
+        # The Ollama server only serves these in parallel if OLLAMA_NUM_PARALLEL (and OLLAMA_MAX_LOADED_MODELS) are set high enough.
+        await self.load_models()
+        self.prepare_deals(n, seed)
+        if concurrency is None:
+            concurrency = max_requests_per_model * len(dict.fromkeys(self.model_names))  # per distinct model, since players can share one.
+        semaphore = asyncio.Semaphore(concurrency)
+        runners = [Runner(self.model_names, cache=self.cache, speculate=self.speculate) for _ in range(n)]
+
+        async def play_game_when_ready(runner, game_index):
+            async with semaphore:
+                runner.deals = self.deals
+                return await runner.play_game(game_index)
+
+        all_history = await asyncio.gather(*[play_game_when_ready(runner, i) for (i, runner) in enumerate(runners)])
+        for runner in runners:
+            self.losses.update(runner.losses)
+            self.deal_losers.update(runner.deal_losers)
+        losses_array = [f"{player}: {losses}" for player, losses in self.losses.items()]
+        log.info("%d games complete.", n)
+        log.info("  Losses: %s", ", ".join(losses_array))
+        return all_history
+
+
+class DeferredQueueHandler(QueueHandler):
+    # QueueHandler that leaves formatting records to the listener's handler, so it happens on the listener's thread too.
+    # Records only cross threads, not processes, so they don't need to be made picklable first.
+    def prepare(self, record):
+        return record
+
+
+# Log to the console from a separate thread, so formatting and writing output doesn't hold up the games.
+log_queue = queue.SimpleQueue()
+log.addHandler(DeferredQueueHandler(log_queue))
+log.setLevel(logging.INFO)
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
 
 runner = Runner(["gemma3:12b", "qwen2.5:14b", "phi4:14b", "mistral-nemo:12b"])
-runner.play_games(100)
\ No newline at end of file
+try:
+    asyncio.run(runner.play_games_async(100))
+finally:
+    log_listener.stop()
\ No newline at end of file